@@ -1,7 +1,10 @@
+import operator
 from typing import Optional, Any
 
 
 class Value:
+    __slots__ = ()
+
     def find(self):
         raise NotImplementedError("abstract")
 
@@ -10,37 +13,54 @@ class Value:
 
 
 class Operation(Value):
-    __match_args__ = ("name", "args")
+    __slots__ = ("name", "args", "forwarded", "_transfer")
 
     def __init__(self, name: str, args: list[Value]):
         self.name = name
-        self._args = args
+        # the arguments. they may have been forwarded
+        # since, see resolved_args(). simplify()
+        # replaces them with their representatives
+        self.args = args
         self.forwarded = None
+        # the parity transfer table for this kind of
+        # operation, filled in by Block._build
+        self._transfer = None
 
     def __repr__(self):
-        return f"Operation({self.name}," f"{self.args}, {self.forwarded})"
+        return f"Operation({self.name}," f"{self.resolved_args()}, {self.forwarded})"
 
     def find(self) -> Value:
         # returns the "representative" value of
-        # self, in the union-find sense
+        # self, in the union-find sense.
+        # most operations are never forwarded, so
+        # check for that before walking the chain
+        if self.forwarded is None:
+            return self
+        return self._find_slow()
+
+    def _find_slow(self) -> Value:
+        # uses path halving: every operation on the
+        # way points to its grandparent afterwards,
+        # so long chains get short quickly
         op = self
         while isinstance(op, Operation):
-            # could do path compression here too
-            # but not essential
             next = op.forwarded
             if next is None:
                 return op
-            op = next
+            if isinstance(next, Operation) and next.forwarded is not None:
+                op.forwarded = next.forwarded
+                op = next.forwarded
+            else:
+                op = next
         return op
 
-    @property
-    def args(self):
-        return tuple(arg.find() for arg in self._args)
+    def resolved_args(self):
+        return tuple(arg.find() for arg in self.args)
 
     def arg(self, index):
         # change to above: return the
         # representative of argument 'index'
-        return self._args[index].find()
+        return self.args[index].find()
 
     def make_equal_to(self, value: Value):
         # this is "union" in the union-find sense,
@@ -49,6 +69,10 @@ class Operation(Value):
         # must be either a Constant or an operation
         # that we know for sure is not optimized
         # away.
+        # that's also why there is no union by rank
+        # here: the rank would pick the direction,
+        # and we can't let it. find() halves paths,
+        # which keeps the chains short anyway.
 
         self.find()._set_forwarded(value)
 
@@ -58,6 +82,7 @@ class Operation(Value):
 
 class Constant(Value):
     __match_args__ = ("value",)
+    __slots__ = ("value",)
 
     def __init__(self, value: Any):
         self.value = value
@@ -83,29 +108,39 @@ class Constant(Value):
 
 
 class Block(list):
-    def opbuilder(opname):
-        def wraparg(arg):
-            if not isinstance(arg, Value):
-                arg = Constant(arg)
-            return arg
-
-        def build(self, *args):
-            # construct an Operation, wrap the
-            # arguments in Constants if necessary
-            op = Operation(opname, [wraparg(arg) for arg in args])
-            # add it to self, the basic block
-            self.append(op)
-            return op
-
-        return build
+    def _build(self, opname: str, args: tuple) -> Operation:
+        # construct an Operation, wrap the
+        # arguments in Constants if necessary
+        op = Operation(
+            opname,
+            [arg if isinstance(arg, Value) else Constant(arg) for arg in args],
+        )
+        # look up its parity transfer table once here,
+        # instead of for every analysis
+        op._transfer = TRANSFER.get(opname)
+        # add it to self, the basic block
+        self.append(op)
+        return op
 
     # a bunch of operations we support
-    add = opbuilder("add")
-    mul = opbuilder("mul")
-    getarg = opbuilder("getarg")
-    dummy = opbuilder("dummy")
-    lshift = opbuilder("lshift")
-    bitand = opbuilder("bitand")
+
+    def add(self, *args):
+        return self._build("add", args)
+
+    def mul(self, *args):
+        return self._build("mul", args)
+
+    def getarg(self, *args):
+        return self._build("getarg", args)
+
+    def dummy(self, *args):
+        return self._build("dummy", args)
+
+    def lshift(self, *args):
+        return self._build("lshift", args)
+
+    def bitand(self, *args):
+        return self._build("bitand", args)
 
 
 def bb_to_str(bb: Block, varprefix: str = "v"):
@@ -113,36 +148,35 @@ def bb_to_str(bb: Block, varprefix: str = "v"):
     # look at the test below to see what the
     # result looks like
 
-    def arg_to_str(arg: Value):
-        if isinstance(arg, Constant):
-            return str(arg.value)
-        else:
-            # the key must exist, otherwise it's
-            # not a valid SSA basic block:
-            # the variable must be defined before
-            # its first use
-            return varnames[arg]
-
     varnames = {}
-    res = []
+    res = [None] * len(bb)
     for index, op in enumerate(bb):
         # give the operation a name used while
         # printing:
         var = f"{varprefix}{index}"
         varnames[op] = var
-        arguments = ", ".join(arg_to_str(op.arg(i)) for i in range(len(op.args)))
-        strop = f"{var} = {op.name}({arguments})"
-        res.append(strop)
+        parts = []
+        for arg in op.args:
+            arg = arg.find()
+            if isinstance(arg, Constant):
+                parts.append(str(arg.value))
+            else:
+                # the key must exist, otherwise it's
+                # not a valid SSA basic block:
+                # the variable must be defined before
+                # its first use
+                parts.append(varnames[arg])
+        res[index] = f"{var} = {op.name}({', '.join(parts)})"
     return "\n".join(res)
 
 
-class Parity:
-    def __init__(self, name):
-        self.name = name
+# the parity lattice, encoded as 2-bit sets of the
+# possible parities, so that the transfer functions
+# below can be turned into table lookups
+BOTTOM, EVEN, ODD, TOP = 0b00, 0b01, 0b10, 0b11
 
-    def __repr__(self):
-        return self.name
 
+class Parity:
     @staticmethod
     def const(value):
         if value.value % 2 == 0:
@@ -150,35 +184,41 @@ class Parity:
         else:
             return ODD
 
-    def getarg(self):
-        return TOP
-
-    def dummy(self):
-        return TOP
+    # the binary transfer functions are only called
+    # at import time, to fill in the tables below
 
-    def add(self, other):
-        if self is BOTTOM or other is BOTTOM:
+    @staticmethod
+    def add(left, right):
+        if left == BOTTOM or right == BOTTOM:
             return BOTTOM
-        if self is TOP or other is TOP:
+        if left == TOP or right == TOP:
             return TOP
-        if self is EVEN and other is EVEN:
+        if left == EVEN and right == EVEN:
             return EVEN
-        if self is ODD and other is ODD:
+        if left == ODD and right == ODD:
             return EVEN
         return ODD
 
-    def lshift(self, other):
-        if self is BOTTOM or other is BOTTOM:
+    @staticmethod
+    def lshift(left, right):
+        if left == BOTTOM or right == BOTTOM:
             return BOTTOM
-        if other is ODD:
+        if right == ODD:
             return EVEN
         return TOP
 
 
-TOP = Parity("top")
-EVEN = Parity("even")
-ODD = Parity("odd")
-BOTTOM = Parity("bottom")
+def _make_table(transfer):
+    # indexed by (left << 2) | right
+    return bytes([transfer(a, b) for a in range(4) for b in range(4)])
+
+
+ADD_TABLE = _make_table(Parity.add)
+LSHIFT_TABLE = _make_table(Parity.lshift)
+
+# operations not in here (getarg, dummy, ...) tell
+# us nothing about the parity of their result
+TRANSFER = {"add": ADD_TABLE, "lshift": LSHIFT_TABLE}
 
 block = Block()
 v0 = block.getarg(0)
@@ -190,6 +230,19 @@ v5 = block.bitand(v4, 1)
 v6 = block.dummy(v5)
 
 
+# how to evaluate each operation, keyed by name:
+# the number of arguments it takes, and a function
+# that gets the value_of helper and the arguments.
+# getarg reads the interpreter's inputs, so interp
+# handles it itself
+INTERP = {
+    "add": (2, lambda value_of, a, b: value_of(a) + value_of(b)),
+    "lshift": (2, lambda value_of, a, b: value_of(a) << value_of(b)),
+    "bitand": (2, lambda value_of, a, b: value_of(a) & value_of(b)),
+    "dummy": (1, lambda value_of, a: value_of(a)),
+}
+
+
 def interp(block, args):
     values = {}
     def value_of(value):
@@ -197,23 +250,103 @@ def interp(block, args):
             return value.value
         return values[value]
     for op in block:
-        match op:
-            case Operation("getarg", [Constant(index)]):
-                values[op] = args[index]
-            case Operation("add", [a, b]):
-                values[op] = value_of(a) + value_of(b)
-            case Operation("lshift", [a, b]):
-                values[op] = value_of(a) << value_of(b)
-            case Operation("bitand", [a, b]):
-                values[op] = value_of(a) & value_of(b)
-            case Operation("dummy", [a]):
-                values[op] = value_of(a)
+        op_args = op.resolved_args()
+        # operations of a shape we don't know how
+        # to evaluate are skipped
+        if op.name == "getarg":
+            if len(op_args) == 1 and isinstance(op_args[0], Constant):
+                values[op] = args[op_args[0].value]
+            continue
+        entry = INTERP.get(op.name)
+        if entry is None:
+            continue
+        arity, handler = entry
+        if len(op_args) == arity:
+            values[op] = handler(value_of, *op_args)
     return values[block[-1]]
 
 
+def _simp_bitand(args, parity_of):
+    # bitand(x, 1) or bitand(1, x)
+    if len(args) != 2:
+        return None
+    left, right = args
+    if isinstance(right, Constant) and right.value == 1:
+        arg = left
+    elif isinstance(left, Constant) and left.value == 1:
+        arg = right
+    else:
+        return None
+    if parity_of(arg) == EVEN:
+        return Constant(0)
+    elif parity_of(arg) == ODD:
+        return Constant(1)
+    return None
+
+
+# rewrite rules, keyed by operation name. each
+# one gets the resolved arguments and returns the
+# value the operation is equal to, or None if it
+# can't be simplified
+SIMPLIFIERS = {
+    "bitand": _simp_bitand,
+}
+
+
+# the largest shift count we fold. the values we
+# model are machine words, so a bigger shift would
+# not fit one anyway; python would happily build an
+# arbitrarily large int at compile time and keep it
+# in the IR, so those shifts are left for run time
+MAX_FOLD_SHIFT = 64
+
+
+def _fold_lshift(left, right):
+    if not 0 <= right <= MAX_FOLD_SHIFT:
+        return None
+    return left << right
+
+
+# operations without side effects, which can be
+# evaluated at compile time if both their arguments
+# are constants. like the rewrite rules, a folder
+# returns None if it doesn't want to fold
+PURE_FOLD = {
+    "add": operator.add,
+    "mul": operator.mul,
+    "lshift": _fold_lshift,
+    "bitand": operator.and_,
+}
+
+
 def simplify(block: Block) -> Block:
-    parity = {v: BOTTOM for v in block}
-    cse = {}
+    # CSE, rewriting and the parity analysis all
+    # happen in this single pass over the block:
+    # the parity of an op is computed right after
+    # it is emitted, which is all the rewrites of
+    # later ops need
+
+    # only filled in for the ops this pass emits.
+    # arguments are always defined before they are
+    # used, so anything else is not a valid block
+    parity: dict[Operation, int] = {}
+    cse: dict[tuple, Operation] = {}
+    consts: dict[tuple, Constant] = {}
+
+    def const_key(const):
+        # equal constants map to the same key for the
+        # rest of this pass, so that the CSE key can
+        # compare arguments by identity. the type is
+        # part of the key to keep e.g. 1 and True
+        # apart. the canonical Constant must never
+        # end up in the IR: values that compare equal
+        # can still behave differently (0.0 and -0.0).
+        # unhashable values are only equal to
+        # themselves
+        try:
+            return id(consts.setdefault((type(const.value), const.value), const))
+        except TypeError:
+            return id(const)
 
     def parity_of(value):
         if isinstance(value, Constant):
@@ -222,30 +355,56 @@ def simplify(block: Block) -> Block:
 
     result = Block()
     for op in block:
-        # CSE
-        name_args = (op.name, tuple(op.args))
+        # resolve the arguments once and reuse them
+        # for everything below
+        args = tuple([arg.find() for arg in op.args])
+        # CSE. constants are canonicalized and
+        # operations are unique, so the arguments can
+        # be keyed by identity
+        name_args = (
+            op.name,
+            *[const_key(arg) if isinstance(arg, Constant) else id(arg) for arg in args],
+        )
         if (prev := cse.get(name_args)) is not None:
             op.make_equal_to(prev)
             continue
+        # Constant-fold. constants can hold any python
+        # value, which the operation may not support;
+        # if evaluating it fails, leave it for run time
+        fold = PURE_FOLD.get(op.name)
+        if (
+            fold is not None
+            and len(args) == 2
+            and isinstance(args[0], Constant)
+            and isinstance(args[1], Constant)
+        ):
+            try:
+                value = fold(args[0].value, args[1].value)
+            except (TypeError, ValueError, OverflowError):
+                value = None
+            if value is not None:
+                op.make_equal_to(Constant(value))
+                continue
         # Try to simplify
-        match op:
-            case Operation("bitand", [arg, Constant(1)]) | Operation("bitand", [Constant(1), arg]):
-                if parity_of(arg) is EVEN:
-                    op.make_equal_to(Constant(0))
-                    continue
-                elif parity_of(arg) is ODD:
-                    op.make_equal_to(Constant(1))
-                    continue
-            case Operation("add", [Constant(l), Constant(r)]):
-                op.make_equal_to(Constant(l + r))
+        handler = SIMPLIFIERS.get(op.name)
+        if handler is not None:
+            res = handler(args, parity_of)
+            if res is not None:
+                op.make_equal_to(res)
                 continue
-        # Emit
+        # Emit. store the representatives of the
+        # arguments, so later passes find them
+        # without walking any forwarding chains
+        op.args = list(args)
         result.append(op)
         cse[name_args] = op
         # Analyze
-        transfer = getattr(Parity, op.name)
-        args = [parity_of(arg) for arg in op.args]
-        parity[op] = transfer(*args)
+        table = op._transfer
+        if table is None or len(args) != 2:
+            parity[op] = TOP
+        else:
+            left, right = args
+            parity[op] = table[(parity_of(left) << 2) | parity_of(right)]
     return result
 
 